@@ -1,102 +1,247 @@
 import asyncio
+from array import array
+from collections import OrderedDict
+from collections.abc import Mapping
+from functools import lru_cache
 from bleak import BleakScanner
+import socket
 import struct
+import sys
 import time
-from datetime import datetime
+
+# 预编译的小端16位打包函数，避免每次调用重新解析格式串
+_U16_PACK = struct.Struct('<H').pack
+
+# 固定的AD结构头部
+_FLAGS_AD = b'\x02\x01\x06'       # Length=2, Type=Flags, Data=0x06
+_UUID16_AD_HEAD = b'\x03\x03'      # Length=3, Type=Complete 16-bit UUIDs
+_AD_TYPE_NAME = 0x09               # Complete Local Name
+_AD_TYPE_SERVICE_DATA = 0x16       # Service Data 16-bit UUID
+_AD_TYPE_MANUFACTURER = 0xFF       # Manufacturer Specific Data
+
+# HCI LE Set Advertising Data命令头: 包类型=Command, OGF=0x08, OCF=0x0008, 参数长度=32
+_HCI_LE_SET_ADV_DATA = b'\x01' + _U16_PACK((0x08 << 10) | 0x0008) + b'\x20'
+
+# 字节 -> 两位大写十六进制字符串的查找表
+_HEX = [f'{i:02X}' for i in range(256)]
+
+
+def _hex(raw, sep=' '):
+    """字节数据转为大写十六进制字符串"""
+    if len(sep) == 1 and sep.isascii():
+        return raw.hex(sep).upper()
+    # bytes.hex只支持单个ASCII字符作为分隔符，其余情况查表
+    return sep.join([_HEX[b] for b in raw])
+
+
+@lru_cache(maxsize=4096)
+def _encode_name(name):
+    """设备名编码为UTF-8并限制长度，同名设备复用结果"""
+    return name.encode('utf-8')[:29]
+
+
+def _hci_cmd(raw):
+    """由原始AD数据生成hcitool命令（补齐到31字节）"""
+    if not raw:
+        return ''
+    hex_str = _hex(raw.ljust(31, b'\x00'))
+    return f"sudo hcitool -i hci0 cmd 0x08 0x0008 {len(raw):02X} {hex_str}"
+
+
+def _hci_packet(raw):
+    """由原始AD数据生成可直接写入HCI套接字的命令包，与_hci_cmd等价"""
+    return _HCI_LE_SET_ADV_DATA + bytes((len(raw),)) + raw.ljust(31, b'\x00')
+
+
+def _format_packet(timestamp, address, name, rssi, raw_data):
+    """格式化单个包的打印信息"""
+    text = (
+        f"时间: {timestamp}\n"
+        f"地址: {address}\n"
+        f"名称: {name}\n"
+        f"RSSI: {rssi} dBm\n"
+    )
+    if raw_data:
+        text += (
+            f"原始数据: {_hex(raw_data)}\n"
+            f"HCI命令: {_hci_cmd(raw_data)}\n"
+        )
+    return text + "-" * 80 + "\n"
+
+
+def _build_ad_data(name, service_uuids, service_data, manufacturer_data):
+    """由广播字段构建AD结构数据（最多31字节）
+    
+    只依赖传入的字段，不访问bleak对象，是解析的热点路径
+    """
+    # 构建AD结构数据（预分配31字节缓冲区，off为当前写入位置）
+    buf = bytearray(31)
+    off = 0
+    
+    # 1. Flags (如果有RSSI说明是可发现的)
+    buf[0:3] = _FLAGS_AD
+    off = 3
+    
+    # 2. Local Name
+    if name:
+        name_bytes = _encode_name(name)
+        if len(name_bytes) > 0:
+            n = len(name_bytes)
+            buf[off:off + 2] = bytes((n + 1, _AD_TYPE_NAME))
+            buf[off + 2:off + 2 + n] = name_bytes
+            off += 2 + n
+    
+    # 3. Service UUIDs
+    if service_uuids:
+        for uuid_str in service_uuids:
+            # 处理16位UUID
+            try:
+                if len(uuid_str) == 36:  # 完整UUID格式，前8位即为32位UUID
+                    uuid_16bit = int(uuid_str[:8], 16) & 0xFFFF
+                else:
+                    # 短UUID
+                    uuid_16bit = int(uuid_str, 16) & 0xFFFF
+            except ValueError:
+                continue
+            buf[off:off + 2] = _UUID16_AD_HEAD
+            buf[off + 2:off + 4] = _U16_PACK(uuid_16bit)
+            off += 4
+    
+    # 4. Service Data
+    if service_data:
+        for uuid_str, data in service_data.items():
+            try:
+                uuid_16bit = int(uuid_str[:8], 16) & 0xFFFF
+            except ValueError:
+                continue
+            service_data_len = 2 + len(data) + 1
+            if service_data_len <= 31:
+                n = len(data)
+                buf[off:off + 2] = bytes((service_data_len, _AD_TYPE_SERVICE_DATA))
+                buf[off + 2:off + 4] = _U16_PACK(uuid_16bit)
+                buf[off + 4:off + 4 + n] = data
+                off += 4 + n
+    
+    # 5. Manufacturer Data
+    if manufacturer_data:
+        for company_id, data in manufacturer_data.items():
+            manu_data_len = 2 + len(data) + 1
+            if manu_data_len <= 31:
+                n = len(data)
+                buf[off:off + 2] = bytes((manu_data_len, _AD_TYPE_MANUFACTURER))
+                buf[off + 2:off + 4] = _U16_PACK(company_id)
+                buf[off + 4:off + 4 + n] = data
+                off += 4 + n
+    
+    # 限制总长度不超过31字节（超出部分的切片赋值会扩展buf，这里截断）
+    if off > 31:
+        off = 31
+    
+    return bytes(buf[:off])
+
+
+class CapturedPacket(Mapping):
+    """已捕获的包，hci_cmd在访问时才生成
+
+    实现只读Mapping接口，可像原来的字典一样使用 packet['hci_cmd']、
+    'name' in packet、packet.get()、dict(packet) 等
+    """
+    __slots__ = ('timestamp', 'address', 'name', 'rssi', 'raw_data')
+    _KEYS = __slots__ + ('hci_cmd',)
+    
+    def __init__(self, timestamp, address, name, rssi, raw_data):
+        self.timestamp = timestamp
+        self.address = address
+        self.name = name
+        self.rssi = rssi
+        self.raw_data = raw_data
+    
+    @property
+    def hci_cmd(self):
+        """重放该包的hcitool命令"""
+        return _hci_cmd(self.raw_data)
+    
+    def __getitem__(self, key):
+        if key not in self._KEYS:
+            raise KeyError(key)
+        return getattr(self, key)
+    
+    def __iter__(self):
+        return iter(self._KEYS)
+    
+    def __len__(self):
+        return len(self._KEYS)
+    
+    def __repr__(self):
+        return (f"CapturedPacket(timestamp={self.timestamp!r}, address={self.address!r}, "
+                f"name={self.name!r}, rssi={self.rssi!r}, raw_data={self.raw_data!r})")
+
 
 class BLEPacketCapture:
-    def __init__(self):
-        self.captured_packets = []
+    def __init__(self, max_packets=10000):
+        if max_packets < 1:
+            raise ValueError(f"max_packets必须至少为1: {max_packets}")
+        # 按列存储的包字段，同一下标（槽位）对应同一个包
+        self._timestamps = []
+        self._addresses = []
+        self._names = []
+        self._rssi = array('i')
+        self._raw = []
+        # (地址, 原始数据) -> 槽位，按首次出现顺序排列，用于O(1)去重和输出
+        self._index = {}
+        # 同样的键按最近出现顺序排列，仅用于淘汰
+        self._recency = OrderedDict()
+        # 最多保留的包数量，超出时淘汰最久未出现的包
+        self.max_packets = max_packets
+        # 地址 -> (广播内容指纹, 去重键)，内容未变时可跳过解析
+        self._last_seen = {}
+        # 按秒缓存格式化后的时间戳
+        self._ts_sec = None
+        self._ts_str = ''
+        # 重放用的HCI原始套接字，首次重放时打开
+        self._hci_sock = None
+        # 没有权限打开HCI套接字时不再尝试，直接使用hcitool
+        self._hci_denied = False
+    
+    @property
+    def captured_packets(self):
+        """已捕获的包列表"""
+        return [self._packet(slot) for slot in self._index.values()]
+    
+    def _packet(self, slot):
+        """把指定槽位的各列组装成包记录"""
+        return CapturedPacket(self._timestamps[slot], self._addresses[slot],
+                              self._names[slot], self._rssi[slot], self._raw[slot])
+    
+    def _timestamp(self):
+        """当前时间字符串，同一秒内复用已格式化的结果"""
+        sec = int(time.time())
+        if sec != self._ts_sec:
+            self._ts_sec = sec
+            self._ts_str = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(sec))
+        return self._ts_str
         
     def parse_advertisement_data(self, device, advertisement_data):
-        """解析广播数据并转换为hcitool格式"""
-        packet_info = {
-            'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-            'address': device.address,
-            'name': device.name or 'Unknown',
-            'rssi': advertisement_data.rssi,
-            'raw_data': [],
-            'hci_cmd': ''
-        }
-        
-        # 构建AD结构数据
-        ad_data = []
-        
-        # 1. Flags (如果有RSSI说明是可发现的)
-        ad_data.extend([0x02, 0x01, 0x06])  # Length=2, Type=Flags, Data=0x06
-        
-        # 2. Local Name
-        if device.name:
-            name_bytes = device.name.encode('utf-8')[:29]  # 限制长度
-            if len(name_bytes) > 0:
-                ad_data.append(len(name_bytes) + 1)
-                ad_data.append(0x09)  # Complete Local Name
-                ad_data.extend(name_bytes)
-        
-        # 3. Service UUIDs
-        if advertisement_data.service_uuids:
-            for uuid_str in advertisement_data.service_uuids:
-                try:
-                    # 处理16位UUID
-                    if len(uuid_str) == 36:  # 完整UUID格式
-                        uuid_16bit = int(uuid_str.split('-')[0], 16) & 0xFFFF
-                        ad_data.extend([0x03, 0x03])  # Length=3, Type=Complete 16-bit UUIDs
-                        ad_data.extend(struct.pack('<H', uuid_16bit))
-                    else:
-                        # 短UUID
-                        uuid_val = int(uuid_str, 16) & 0xFFFF
-                        ad_data.extend([0x03, 0x03])
-                        ad_data.extend(struct.pack('<H', uuid_val))
-                except:
-                    pass
+        """解析广播数据为AD结构
         
-        # 4. Service Data
-        if hasattr(advertisement_data, 'service_data') and advertisement_data.service_data:
-            for uuid_str, data in advertisement_data.service_data.items():
-                try:
-                    uuid_16bit = int(uuid_str.split('-')[0], 16) & 0xFFFF
-                    service_data_len = 2 + len(data) + 1
-                    if service_data_len <= 31:
-                        ad_data.append(service_data_len)
-                        ad_data.append(0x16)  # Service Data 16-bit UUID
-                        ad_data.extend(struct.pack('<H', uuid_16bit))
-                        ad_data.extend(data)
-                except:
-                    pass
-        
-        # 5. Manufacturer Data
-        if hasattr(advertisement_data, 'manufacturer_data') and advertisement_data.manufacturer_data:
-            for company_id, data in advertisement_data.manufacturer_data.items():
-                manu_data_len = 2 + len(data) + 1
-                if manu_data_len <= 31:
-                    ad_data.append(manu_data_len)
-                    ad_data.append(0xFF)  # Manufacturer Specific Data
-                    ad_data.extend(struct.pack('<H', company_id))
-                    ad_data.extend(data)
-        
-        # 限制总长度不超过31字节
-        if len(ad_data) > 31:
-            ad_data = ad_data[:31]
+        返回 (timestamp, address, name, rssi, raw_data) 元组，
+        hcitool命令在需要时由 _hci_cmd(raw_data) 生成
+        """
+        raw_data = _build_ad_data(device.name, advertisement_data.service_uuids,
+                                  advertisement_data.service_data,
+                                  advertisement_data.manufacturer_data)
         
-        # 生成hcitool命令
-        if ad_data:
-            data_length = len(ad_data)
-            # 补齐到31字节（用0填充）
-            ad_data_padded = ad_data + [0x00] * (31 - len(ad_data))
-            
-            hci_params = [f'{data_length:02X}'] + [f'{b:02X}' for b in ad_data_padded]
-            hci_cmd = f"sudo hcitool -i hci0 cmd 0x08 0x0008 {' '.join(hci_params)}"
-            
-            packet_info['raw_data'] = ad_data
-            packet_info['hci_cmd'] = hci_cmd
-        
-        return packet_info
+        return (self._timestamp(), device.address, device.name or 'Unknown',
+                advertisement_data.rssi, raw_data)
     
     async def scan_and_capture(self, duration=30, target_names=None, target_addresses=None):
         """扫描并捕获BLE广播包"""
         print(f"开始扫描BLE设备，持续{duration}秒...")
         print("=" * 80)
         
+        # 新包的信息交给后台任务打印，避免在回调中阻塞于终端输出
+        print_queue = asyncio.Queue()
+        
         def detection_callback(device, advertisement_data):
             # 过滤条件
             if target_names and device.name not in target_names:
@@ -104,81 +249,190 @@ class BLEPacketCapture:
             if target_addresses and device.address not in target_addresses:
                 return
             
-            packet = self.parse_advertisement_data(device, advertisement_data)
+            # 同一设备的广播内容未变时，直接更新时间戳和RSSI，跳过解析
+            fingerprint = (
+                device.name,
+                tuple(advertisement_data.service_uuids),
+                tuple(advertisement_data.service_data.items()),
+                tuple(advertisement_data.manufacturer_data.items()),
+            )
+            last = self._last_seen.get(device.address)
+            if last is not None and last[0] == fingerprint:
+                slot = self._index.get(last[1])
+                if slot is not None:
+                    self._timestamps[slot] = self._timestamp()
+                    self._rssi[slot] = advertisement_data.rssi
+                    self._recency.move_to_end(last[1])
+                    return
+            
+            timestamp, address, name, rssi, raw_data = \
+                self.parse_advertisement_data(device, advertisement_data)
             
             # 避免重复记录相同设备
-            existing = next((p for p in self.captured_packets 
-                           if p['address'] == packet['address'] and p["raw_data"] == packet["raw_data"]), None)
+            key = (address, raw_data)
+            self._last_seen[address] = (fingerprint, key)
+            slot = self._index.get(key)
             
-            if existing:
+            if slot is not None:
                 # 更新时间戳和RSSI
-                existing['timestamp'] = packet['timestamp']
-                existing['rssi'] = packet['rssi']
+                self._timestamps[slot] = timestamp
+                self._rssi[slot] = rssi
+                self._recency.move_to_end(key)
+                return
+            
+            if len(self._index) >= self.max_packets:
+                # 淘汰最久未出现的包，复用其槽位
+                old_key, _ = self._recency.popitem(last=False)
+                slot = self._index.pop(old_key)
+                old_last = self._last_seen.get(old_key[0])
+                if old_last is not None and old_last[1] == old_key:
+                    del self._last_seen[old_key[0]]
+                self._timestamps[slot] = timestamp
+                self._addresses[slot] = address
+                self._names[slot] = name
+                self._rssi[slot] = rssi
+                self._raw[slot] = raw_data
             else:
-                self.captured_packets.append(packet)
-                self.print_packet_info(packet)
+                slot = len(self._raw)
+                self._timestamps.append(timestamp)
+                self._addresses.append(address)
+                self._names.append(name)
+                self._rssi.append(rssi)
+                self._raw.append(raw_data)
+            self._index[key] = slot
+            self._recency[key] = None
+            # 入队的是字段快照，槽位之后可能被淘汰复用
+            print_queue.put_nowait((timestamp, address, name, rssi, raw_data))
         
         # 开始扫描
-        async with BleakScanner(detection_callback) as scanner:
-            await asyncio.sleep(duration)
+        printer = asyncio.create_task(self._drain_printer(print_queue))
+        try:
+            async with BleakScanner(detection_callback) as scanner:
+                await asyncio.sleep(duration)
+        finally:
+            printer.cancel()
+            try:
+                await printer
+            except asyncio.CancelledError:
+                pass
+            # 打印队列中剩余的包
+            self._write_packets(print_queue)
         
         print("\n扫描完成!")
         return self.captured_packets
     
+    async def _drain_printer(self, queue):
+        """后台打印任务，每次把队列中已有的包合并为一次写出"""
+        while True:
+            packet = await queue.get()
+            sys.stdout.write(_format_packet(*packet))
+            self._write_packets(queue)
+    
+    def _write_packets(self, queue):
+        """取出队列中当前所有的包并一次性写到标准输出"""
+        parts = []
+        while not queue.empty():
+            parts.append(_format_packet(*queue.get_nowait()))
+        if parts:
+            sys.stdout.write(''.join(parts))
+        sys.stdout.flush()
+    
     def print_packet_info(self, packet):
-        """打印包信息"""
-        print(f"时间: {packet['timestamp']}")
-        print(f"地址: {packet['address']}")
-        print(f"名称: {packet['name']}")
-        print(f"RSSI: {packet['rssi']} dBm")
-        if packet['raw_data']:
-            print(f"原始数据: {' '.join(f'{b:02X}' for b in packet['raw_data'])}")
-            print(f"HCI命令: {packet['hci_cmd']}")
-        print("-" * 80)
+        """打印包信息（packet为captured_packets中的元素）"""
+        sys.stdout.write(_format_packet(packet['timestamp'], packet['address'],
+                                        packet['name'], packet['rssi'], packet['raw_data']))
     
     def save_to_file(self, filename="captured_ble_packets.txt"):
         """保存到文件"""
-        with open(filename, 'w', encoding='utf-8') as f:
-            f.write("BLE广播包捕获结果\n")
-            f.write("=" * 80 + "\n\n")
-            
-            for i, packet in enumerate(self.captured_packets, 1):
-                f.write(f"包 #{i}\n")
-                f.write(f"时间: {packet['timestamp']}\n")
-                f.write(f"地址: {packet['address']}\n")
-                f.write(f"名称: {packet['name']}\n")
-                f.write(f"RSSI: {packet['rssi']} dBm\n")
-                
-                if packet['raw_data']:
-                    f.write(f"原始数据: {' '.join(f'{b:02X}' for b in packet['raw_data'])}\n")
-                    f.write(f"HCI命令:\n{packet['hci_cmd']}\n")
-                f.write("\n" + "-" * 80 + "\n\n")
+        # 先拼好所有内容，再一次性写入
+        parts = ["BLE广播包捕获结果\n", "=" * 80 + "\n\n"]
+        separator = "\n" + "-" * 80 + "\n\n"
+        for i, slot in enumerate(self._index.values(), 1):
+            parts.append(
+                f"包 #{i}\n"
+                f"时间: {self._timestamps[slot]}\n"
+                f"地址: {self._addresses[slot]}\n"
+                f"名称: {self._names[slot]}\n"
+                f"RSSI: {self._rssi[slot]} dBm\n"
+            )
+            raw_data = self._raw[slot]
+            if raw_data:
+                parts.append(
+                    f"原始数据: {_hex(raw_data)}\n"
+                    f"HCI命令:\n{_hci_cmd(raw_data)}\n"
+                )
+            parts.append(separator)
+        
+        with open(filename, 'w', encoding='utf-8', buffering=1 << 20) as f:
+            f.writelines(parts)
         
         print(f"结果已保存到: {filename}")
     
     def get_hci_commands(self):
         """获取所有HCI命令列表"""
         commands = []
-        for packet in self.captured_packets:
-            if packet['hci_cmd']:
+        for slot in self._index.values():
+            raw_data = self._raw[slot]
+            if raw_data:
                 commands.append({
-                    'name': packet['name'],
-                    'address': packet['address'],
-                    'command': packet['hci_cmd']
+                    'name': self._names[slot],
+                    'address': self._addresses[slot],
+                    'command': _hci_cmd(raw_data)
                 })
         return commands
     
+    def _hci_socket(self):
+        """获取绑定到hci0的HCI原始套接字（需要root或CAP_NET_RAW权限）"""
+        if self._hci_sock is None:
+            # Windows等平台有AF_BLUETOOTH但没有BTPROTO_HCI
+            if getattr(socket, 'BTPROTO_HCI', None) is None:
+                raise OSError("当前平台不支持HCI原始套接字")
+            sock = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_RAW, socket.BTPROTO_HCI)
+            try:
+                sock.bind((0,))  # hci0
+            except OSError:
+                sock.close()
+                raise
+            self._hci_sock = sock
+        return self._hci_sock
+    
+    def close(self):
+        """关闭重放时打开的HCI套接字"""
+        if self._hci_sock is not None:
+            self._hci_sock.close()
+            self._hci_sock = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+    
     def replay_packet(self, index):
         """重放指定的包"""
-        if 0 <= index < len(self.captured_packets):
-            packet = self.captured_packets[index]
-            if packet['hci_cmd']:
-                print(f"重放包 #{index + 1}: {packet['name']} ({packet['address']})")
-                print(f"执行命令: {packet['hci_cmd']}")
+        if 0 <= index < len(self._index):
+            slot = list(self._index.values())[index]
+            hci_cmd = _hci_cmd(self._raw[slot])
+            if hci_cmd:
+                print(f"重放包 #{index + 1}: {self._names[slot]} ({self._addresses[slot]})")
                 
-                # 这里可以直接执行命令
+                # 优先直接写入HCI套接字，避免每次重放都启动hcitool进程
+                if not self._hci_denied:
+                    try:
+                        self._hci_socket().send(_hci_packet(self._raw[slot]))
+                        # 未等待Command Complete事件，只能确认命令已写入
+                        print("✓ 命令已发送到hci0")
+                        return
+                    except OSError as e:
+                        # 丢弃出错的套接字，下次重放重新打开
+                        self.close()
+                        if isinstance(e, PermissionError):
+                            self._hci_denied = True
+                        print(f"HCI套接字不可用({e})，改用hcitool")
+                
+                print(f"执行命令: {hci_cmd}")
                 import subprocess
-                cmd = packet['hci_cmd'].split()
+                cmd = hci_cmd.split()
                 try:
                     result = subprocess.run(cmd, capture_output=True, text=True)
                     if result.returncode == 0:
@@ -213,7 +467,7 @@ async def main():
     # )
     
     # 保存结果
-    capture.save_to_file("ble_capture.txt")
+    await asyncio.to_thread(capture.save_to_file, "ble_capture.txt")
     
     # 显示所有HCI命令
     print("\n=== 捕获的HCI命令 ===")
@@ -225,16 +479,23 @@ async def main():
     
     # 交互式重放
     if commands:
-        while True:
-            try:
-                choice = input(f"选择要重放的包 (1-{len(commands)}, 或输入 'q' 退出): ")
-                if choice.lower() == 'q':
+        with capture:
+            while True:
+                try:
+                    choice = input(f"选择要重放的包 (1-{len(commands)}, 或输入 'q' 退出): ")
+                    if choice.lower() == 'q':
+                        break
+                    index = int(choice) - 1
+                    capture.replay_packet(index)
+                    print()
+                except (ValueError, KeyboardInterrupt):
                     break
-                index = int(choice) - 1
-                capture.replay_packet(index)
-                print()
-            except (ValueError, KeyboardInterrupt):
-                break
 
 if __name__ == "__main__":
+    # 如果安装了uvloop则使用它，降低高频回调下事件循环的开销
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
     asyncio.run(main())